@@ -1,11 +1,185 @@
 #!/usr/bin/env python3
 import cv2
+import numpy as np
 import os
 import re
+import shutil
+import struct
+import subprocess
 import sys
+from collections import deque
+from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-def create_video_from_images(images_dir, output_video, fps=5):
+# Number of frames decoded ahead of the VideoWriter in the OpenCV path
+PREFETCH_DEPTH = 16
+
+# Decode / encode threads per video when several videos are rendered in parallel
+POOL_WORKER_THREADS = 2
+
+# Default OpenCV FourCC per container. MJPG and FFV1 are much cheaper to encode
+# than MPEG-4/H.264, at the cost of larger files (FFV1 is lossless).
+FOURCC_BY_EXTENSION = {".avi": "MJPG", ".mkv": "FFV1", ".mp4": "mp4v"}
+
+# ffmpeg encoder used for a FourCC in the ffmpeg fast path (.mp4 uses libx264)
+FFMPEG_ENCODER_BY_FOURCC = {
+    "MJPG": "mjpeg",
+    "FFV1": "ffv1",
+    "mp4v": "libx264",
+    "avc1": "libx264",
+    "H264": "libx264",
+}
+
+# Container used for a FourCC when the output path is derived from the codec
+EXTENSION_BY_FOURCC = {
+    "MJPG": ".avi",
+    "FFV1": ".mkv",
+    "mp4v": ".mp4",
+    "avc1": ".mp4",
+    "H264": ".mp4",
+}
+
+# FourCCs for which the NVENC (H.264) writer may be used instead
+H264_FOURCCS = ("mp4v", "avc1", "H264")
+
+NUMBER_RE = re.compile(r'(\d+)')
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+def extract_number(filename):
+    """Extract number from filename (e.g., "5.png" -> 5, "130.png" -> 130)."""
+    # Fast path for purely numeric stems, the regex is only needed for other names
+    dot = filename.find('.')
+    stem = filename[:dot] if dot >= 0 else filename
+    if stem.isdecimal():
+        return int(stem)
+    match = NUMBER_RE.search(filename)
+    return int(match.group(1)) if match else 0
+
+def read_image_size(image_path, parse_jpeg=True):
+    """
+    Read (width, height) from the image header without decoding the pixels.
+
+    Note that the JPEG size ignores the EXIF orientation, which cv2.imread applies.
+
+    Args:
+        image_path: Path of a PNG or JPEG file
+        parse_jpeg: Also read the size of JPEG files (default: True)
+
+    Returns:
+        (width, height) or None if the format is not supported
+    """
+    try:
+        with open(image_path, "rb") as f:
+            header = f.read(24)
+            # PNG: 8 byte signature, then the IHDR chunk with big-endian width and height
+            if len(header) == 24 and header.startswith(PNG_SIGNATURE) and header[12:16] == b"IHDR":
+                return struct.unpack(">II", header[16:24])
+            if parse_jpeg and header.startswith(b"\xff\xd8"):
+                f.seek(2)
+                return read_jpeg_size(f)
+    except (OSError, IndexError, struct.error):
+        pass
+    return None
+
+def read_jpeg_size(f):
+    """Walk the JPEG marker segments of `f` until the SOF segment holding the frame size."""
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        code = marker[1]
+        while code == 0xFF:  # fill bytes
+            code = f.read(1)[0]
+        if code == 0x01 or 0xD0 <= code <= 0xD8:  # markers without a length field
+            continue
+        (length,) = struct.unpack(">H", f.read(2))
+        # SOF0-SOF15, except DHT (C4), JPG (C8) and DAC (CC)
+        if 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+            # precision (1 byte), height, width
+            height, width = struct.unpack(">xHH", f.read(5))
+            return width, height
+        f.seek(length - 2, os.SEEK_CUR)
+
+def write_video_with_ffmpeg(image_paths, output_video, fps, video_codec="libx264", threads=0, verbose=True):
+    """
+    Stream the encoded image files straight into ffmpeg without decoding them in Python.
+
+    Args:
+        image_paths: Sorted list of image file paths (all of the same format)
+        output_video: Output video file path
+        fps: Frames per second
+        video_codec: ffmpeg encoder, e.g. "h264_nvenc" to encode on the GPU
+        threads: Number of encoder threads (default: 0, chosen by ffmpeg)
+        verbose: Print progress every 10 frames (default: True)
+
+    Returns:
+        True if ffmpeg finished successfully, False otherwise
+    """
+    command = [
+        "ffmpeg", "-y", "-loglevel", "error",
+        "-f", "image2pipe", "-framerate", str(fps), "-i", "-",
+        "-c:v", video_codec, "-threads", str(threads),
+    ]
+    if video_codec == "mjpeg":
+        command += ["-q:v", "2"]
+    elif video_codec != "ffv1":
+        # yuv420p needs even dimensions, pad by one pixel if necessary
+        command += ["-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2", "-pix_fmt", "yuv420p"]
+    command.append(output_video)
+    proc = subprocess.Popen(command, stdin=subprocess.PIPE, bufsize=1 << 20)
+    try:
+        for i, image_path in enumerate(image_paths):
+            with open(image_path, "rb") as f:
+                proc.stdin.write(f.read())
+            if verbose and (i + 1) % 10 == 0:
+                print(f"Processed {i + 1}/{len(image_paths)} images...")
+    except BrokenPipeError:
+        pass
+    finally:
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+    return proc.wait() == 0
+
+class CudaVideoWriter:
+    """Thin wrapper around cv2.cudacodec.VideoWriter (NVENC) that accepts host images."""
+
+    def __init__(self, output_video, fps, frame_size):
+        self.stream = cv2.cuda_Stream()
+        self.writer = cv2.cudacodec.createVideoWriter(
+            output_video, frame_size, codec=cv2.cudacodec.H264, fps=fps, stream=self.stream
+        )
+        # Reuse one device buffer for all frames
+        self.gpu_frame = cv2.cuda_GpuMat()
+
+    def write(self, img):
+        self.gpu_frame.upload(img, self.stream)
+        self.writer.write(self.gpu_frame)
+
+    def release(self):
+        self.writer.release()
+
+def open_video_writer(output_video, fps, frame_size, codec="mp4v"):
+    """
+    Open a GPU (NVENC) video writer for H.264-style codecs if OpenCV was built with
+    cudacodec and a CUDA device is present, otherwise the software cv2.VideoWriter.
+    """
+    try:
+        if codec in H264_FOURCCS and cv2.cuda.getCudaEnabledDeviceCount() > 0:
+            writer = CudaVideoWriter(output_video, fps, frame_size)
+            print("Using NVENC encoder (cv2.cudacodec)")
+            return writer
+    # AttributeError: no CUDA support in this build; TypeError: cudacodec without
+    # the OpenCV >= 4.7 createVideoWriter keywords (codec=, fps=, stream=)
+    except (AttributeError, TypeError, cv2.error):
+        pass
+    fourcc = cv2.VideoWriter_fourcc(*codec)
+    return cv2.VideoWriter(output_video, fourcc, fps, frame_size)
+
+def create_video_from_images(images_dir, output_video, fps=5, codec=None, num_workers=None, verbose=True):
     """
     Create a video from images in a directory with numeric sorting.
     
@@ -13,70 +187,193 @@ def create_video_from_images(images_dir, output_video, fps=5):
         images_dir: Directory containing image files
         output_video: Output video file path
         fps: Frames per second (default: 5)
+        codec: FourCC of the video codec, e.g. 'MJPG', 'FFV1' or 'mp4v'
+            (default: chosen from the output extension, MJPG for .avi)
+        num_workers: Decode threads of the OpenCV path and encoder threads of
+            ffmpeg (default: up to PREFETCH_DEPTH decode threads, ffmpeg picks)
+        verbose: Print the image list and progress (default: True); warnings and
+            errors are always printed
+    
+    Returns:
+        True if the video was written, False otherwise
     """
-    # Get all image files
-    image_files = [f for f in os.listdir(images_dir) if f.endswith(('.png', '.jpg', '.jpeg'))]
+    if codec is None:
+        extension = os.path.splitext(output_video)[1].lower()
+        codec = FOURCC_BY_EXTENSION.get(extension, "mp4v")
+
+    # Get all image files in a single directory pass
+    with os.scandir(images_dir) as entries:
+        image_files = [
+            entry.name for entry in entries
+            if entry.name.lower().endswith(('.png', '.jpg', '.jpeg'))
+            and entry.is_file()
+        ]
     
     # Sort numerically by extracting the number from filename
-    def extract_number(filename):
-        # Extract number from filename (e.g., "5.png" -> 5, "130.png" -> 130)
-        match = re.search(r'(\d+)', filename)
-        return int(match.group(1)) if match else 0
-    
     image_files.sort(key=extract_number)
     
     if not image_files:
         print(f"No image files found in {images_dir}")
-        return
-    
-    print(f"Found {len(image_files)} images. First few: {image_files[:5]}")
-    print(f"Last few: {image_files[-5:]}")
+        return False
     
-    # Read first image to get dimensions
-    first_image_path = os.path.join(images_dir, image_files[0])
-    frame = cv2.imread(first_image_path)
+    if verbose:
+        print(f"Found {len(image_files)} images. First few: {image_files[:5]}")
+        print(f"Last few: {image_files[-5:]}")
     
-    if frame is None:
-        print(f"Error: Could not read first image: {first_image_path}")
-        return
+    # Build all paths once; joining with a precomputed prefix avoids a full
+    # os.path.join per frame
+    prefix = os.path.join(os.fspath(images_dir), "")
+    image_paths = [prefix + f for f in image_files]
     
-    height, width, layers = frame.shape
-    print(f"Image dimensions: {width}x{height}")
+    # Fast path: hand the raw files to ffmpeg, which decodes and encodes in one pass.
+    # image2pipe detects the format and frame size once, so this only works for a
+    # homogeneous PNG/JPEG stream; mixed inputs go through OpenCV below.
+    extensions = {os.path.splitext(f)[1].lower() for f in image_files}
+    if shutil.which("ffmpeg") and len(extensions) == 1:
+        sizes = {read_image_size(path) for path in image_paths}
+        homogeneous = len(sizes) == 1 and None not in sizes
+    else:
+        homogeneous = False
     
-    # Define codec and create VideoWriter
-    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-    video = cv2.VideoWriter(output_video, fourcc, fps, (width, height))
+    ffmpeg_encoder = FFMPEG_ENCODER_BY_FOURCC.get(codec)
+    if homogeneous and ffmpeg_encoder is not None:
+        if write_video_with_ffmpeg(
+            image_paths, output_video, fps, ffmpeg_encoder, threads=num_workers or 0, verbose=verbose
+        ):
+            if verbose:
+                print(f"Video created successfully: {output_video}")
+            return True
+        print("Warning: ffmpeg failed, falling back to OpenCV VideoWriter...")
     
-    # Write all frames
-    for i, image_file in enumerate(image_files):
-        image_path = os.path.join(images_dir, image_file)
-        img = cv2.imread(image_path)
+    # Get dimensions from the header of the first image if it is a PNG. JPEGs are
+    # decoded, since cv2.imread applies the EXIF orientation and may swap the
+    # width and height given in the header.
+    first_image_path = image_paths[0]
+    size = read_image_size(first_image_path, parse_jpeg=False)
+    if size is None:
+        frame = cv2.imread(first_image_path)
         
-        if img is None:
-            print(f"Warning: Could not read image {image_file}, skipping...")
-            continue
+        if frame is None:
+            print(f"Error: Could not read first image: {first_image_path}")
+            return False
         
-        video.write(img)
-        if (i + 1) % 10 == 0:
-            print(f"Processed {i + 1}/{len(image_files)} images...")
+        height, width = frame.shape[:2]
+    else:
+        width, height = size
+    if verbose:
+        print(f"Image dimensions: {width}x{height}")
+    
+    # Create VideoWriter (NVENC when available)
+    video = open_video_writer(output_video, fps, (width, height), codec)
+    
+    # Contiguous BGR buffer reused for frames that have to be resized to the video
+    # size (VideoWriter silently drops frames of a different size)
+    frame_buf = np.empty((height, width, 3), dtype=np.uint8)
+    
+    # Write all frames, decoding the next PREFETCH_DEPTH images in worker threads
+    # (cv2.imread releases the GIL) while the current one is being encoded
+    decode_workers = num_workers or min(PREFETCH_DEPTH, os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=decode_workers) as executor:
+        pending = deque()
+        next_idx = 0
+        for i, image_file in enumerate(image_files):
+            while next_idx < len(image_paths) and len(pending) < PREFETCH_DEPTH:
+                pending.append(executor.submit(cv2.imread, image_paths[next_idx], cv2.IMREAD_COLOR))
+                next_idx += 1
+            img = pending.popleft().result()
+            
+            if img is None:
+                print(f"Warning: Could not read image {image_file}, skipping...")
+                continue
+            
+            if img.shape != frame_buf.shape:
+                img = cv2.resize(img, (width, height), dst=frame_buf)
+            video.write(img)
+            if verbose and (i + 1) % 10 == 0:
+                print(f"Processed {i + 1}/{len(image_files)} images...")
     
     video.release()
-    print(f"Video created successfully: {output_video}")
+    if verbose:
+        print(f"Video created successfully: {output_video}")
+    return True
+
+def find_viz_dirs(root):
+    """
+    Find all route directories below `root` that live in a directory named "viz",
+    i.e. <out_root>/<agent>/<benchmark>/<seed>/viz/<route_id>.
+    """
+    viz_dirs = []
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if not entry.is_dir() or entry.name.startswith('.'):
+                continue
+            if entry.name == "viz":
+                with os.scandir(entry.path) as routes:
+                    viz_dirs.extend(
+                        route.path for route in routes
+                        # Hidden directories are old attempts that are being deleted
+                        if route.is_dir() and not route.name.startswith('.')
+                    )
+            else:
+                viz_dirs.extend(find_viz_dirs(entry.path))
+    return sorted(viz_dirs)
+
+def init_video_worker():
+    """Pool initializer: the pool already uses all cores, keep OpenCV single-threaded."""
+    cv2.setNumThreads(1)
+
+def create_video_task(viz_dir, output_video, fps, codec):
+    """Render one route in a pool worker, printing a single line instead of progress."""
+    if create_video_from_images(
+        viz_dir, output_video, fps, codec, num_workers=POOL_WORKER_THREADS, verbose=False
+    ):
+        print(f"Video created: {output_video}")
+    else:
+        print(f"Failed to create video for {viz_dir}")
+
+def create_videos_for_eval(out_root, fps=5, codec="MJPG"):
+    """
+    Create one video per route for all viz/<route_id> directories below out_root,
+    rendering the routes in parallel worker processes.
+    
+    Args:
+        out_root: Evaluation output directory (searched recursively)
+        fps: Frames per second (default: 5)
+        codec: FourCC of the video codec (default: MJPG)
+    """
+    viz_dirs = find_viz_dirs(out_root)
+    if not viz_dirs:
+        print(f"No viz directories found in {out_root}")
+        return
+    
+    extension = EXTENSION_BY_FOURCC.get(codec, ".avi")
+    tasks = [
+        (viz_dir, os.path.join(viz_dir, "output_video" + extension), fps, codec)
+        for viz_dir in viz_dirs
+    ]
+    print(f"Creating {len(tasks)} videos...")
+    # Each worker renders with POOL_WORKER_THREADS threads, so size the pool to
+    # keep the total close to the number of cores
+    processes = max(1, min((os.cpu_count() or 1) // POOL_WORKER_THREADS, len(tasks)))
+    with Pool(processes=processes, initializer=init_video_worker) as pool:
+        pool.starmap(create_video_task, tasks)
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
-        print("Usage: python create_video_from_images.py <images_dir> [fps]")
+        print("Usage: python create_video_from_images.py <images_dir> [fps] [codec]")
         print("Example: python create_video_from_images.py /path/to/images 5")
+        print("Example: python create_video_from_images.py /path/to/images 5 mp4v")
         sys.exit(1)
     
     images_dir = sys.argv[1]
     fps = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    codec = sys.argv[3] if len(sys.argv) > 3 else "MJPG"
     
-    # Output video in the same folder as images
-    output_video = os.path.join(images_dir, "output_video.mp4")
+    # Output video in the same folder as images, container matching the codec
+    output_video = os.path.join(images_dir, "output_video" + EXTENSION_BY_FOURCC.get(codec, ".avi"))
     
     if not os.path.isdir(images_dir):
         print(f"Error: {images_dir} is not a valid directory")
         sys.exit(1)
     
-    create_video_from_images(images_dir, output_video, fps)
+    create_video_from_images(images_dir, output_video, fps, codec)
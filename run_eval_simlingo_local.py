@@ -3,14 +3,15 @@
 Local Bench2Drive evaluation launcher for SimLingo.
 
 This script mirrors the logic of start_eval_simlingo.py but executes the jobs
-sequentially on a single machine without SLURM. Update the CONFIGS list at the
-bottom with your paths before running:
+on a single machine without SLURM, running one job per CARLA server at a time.
+Update the CONFIGS list at the bottom with your paths before running:
 
     python run_eval_simlingo_local.py
 
 Prerequisites:
   * A CARLA server (0.9.15) must be running and listening on the configured
-    ports (carla_port / carla_tm_port).
+    ports (carla_port / carla_tm_port). To run several routes in parallel,
+    start one server per entry of carla_ports and list all of them there.
   * The Conda/venv that contains SimLingo dependencies should be activated.
 """
 
@@ -19,18 +20,44 @@ from __future__ import annotations
 import os
 import shutil
 import subprocess
+import sys
+import threading
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from queue import Queue
 from pathlib import Path
-from typing import Dict, List
+from typing import IO, Deque, Dict, Iterable, List, Optional, Tuple
 
 import ujson
-from tqdm.autonotebook import tqdm
+from tqdm import tqdm
+
+FAIL_STATUSES = frozenset(
+    map(
+        sys.intern,
+        (
+            "Failed - Agent couldn't be set up",
+            "Failed",
+            "Failed - Simulation crashed",
+            "Failed - Agent crashed",
+        ),
+    )
+)
+
+# Buffer size for the log files opened by the launcher
+LOG_BUFFER_SIZE = 1 << 20
+
+# Lines of stdout / stderr kept in memory per job when logs are only written on failure
+LOG_TAIL_LINES = 10000
+
+# needs_rerun() decisions keyed on (path, st_mtime_ns, st_size) of the result file
+_result_cache: Dict[Tuple[str, int, int], bool] = {}
+
+# Set by main() when the launcher is interrupted; workers stop retrying their jobs
+_stop_requested = threading.Event()
 
-FAIL_STATUSES = {
-    "Failed - Agent couldn't be set up",
-    "Failed",
-    "Failed - Simulation crashed",
-    "Failed - Agent crashed",
-}
+# Path.exists() results, shared across configs that point to the same files
+_path_exists_cache: Dict[str, bool] = {}
 
 
 def expand_path(path: str) -> str:
@@ -38,6 +65,15 @@ def expand_path(path: str) -> str:
     return os.path.abspath(os.path.expanduser(path))
 
 
+def _exists(path: Path) -> bool:
+    """Memoized Path.exists(); each unique path is stat'ed once."""
+    key = str(path)
+    exists = _path_exists_cache.get(key)
+    if exists is None:
+        exists = _path_exists_cache[key] = path.exists()
+    return exists
+
+
 def preprocess_config(cfg: Dict) -> Dict:
     """Resolve paths and fill defaults."""
     cfg = cfg.copy()
@@ -55,8 +91,12 @@ def preprocess_config(cfg: Dict) -> Dict:
 
     cfg.setdefault("carla_port", 2000)
     cfg.setdefault("carla_tm_port", 2500)
+    cfg.setdefault("carla_ports", [(cfg["carla_port"], cfg["carla_tm_port"])])
+    cfg["carla_ports"] = [tuple(int(p) for p in pair) for pair in cfg["carla_ports"]]
     cfg.setdefault("timeout", 600)
     cfg.setdefault("tries", 1)
+    cfg.setdefault("keep_logs_on_success", False)
+    cfg.setdefault("create_videos", False)
 
     required_paths = {
         "route_path": Path(cfg["route_path"]),
@@ -65,23 +105,42 @@ def preprocess_config(cfg: Dict) -> Dict:
         "agent_file": Path(cfg["agent_file"]),
         "checkpoint": Path(cfg["checkpoint"]),
     }
-    for name, path in required_paths.items():
-        if not path.exists():
-            raise FileNotFoundError(f"{name} does not exist: {path}")
+    missing = [(name, path) for name, path in required_paths.items() if not _exists(path)]
+    if missing:
+        raise FileNotFoundError(
+            "Required paths do not exist: "
+            + ", ".join(f"{name}={path}" for name, path in missing)
+        )
 
     return cfg
 
 
 def discover_routes(route_dir: Path) -> List[Path]:
     """Return sorted list of .xml route files."""
-    return sorted([p for p in route_dir.iterdir() if p.suffix == ".xml"])
+    with os.scandir(route_dir) as entries:
+        names = sorted(entry.name for entry in entries if entry.name.endswith(".xml"))
+    return [route_dir / name for name in names]
+
+
+def make_dirs(dirs: Iterable[Path], max_workers: int = 16) -> None:
+    """Create each unique directory once, issuing the mkdir calls concurrently."""
+    unique_dirs = set(dirs)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # list() propagates the first mkdir error, if any
+        list(
+            executor.map(
+                lambda d: d.mkdir(parents=True, exist_ok=True), unique_dirs
+            )
+        )
 
 
 def build_job_queue(configs: List[Dict]) -> List[Dict]:
     """Create job descriptions for all configs / seeds / routes."""
     job_queue: List[Dict] = []
+    dirs_to_create = set()
     for cfg_idx, raw_cfg in enumerate(configs):
         cfg = preprocess_config(raw_cfg)
+        env_template = prepare_environment(cfg)
         route_dir = Path(cfg["route_path"])
         routes = discover_routes(route_dir)
 
@@ -96,15 +155,14 @@ def build_job_queue(configs: List[Dict]) -> List[Dict]:
             seed_str = str(seed_int)
 
             base_dir = Path(cfg["out_root"]) / cfg["agent"] / cfg["benchmark"] / seed_str
-            for sub in ("run", "res", "out", "err"):
-                (base_dir / sub).mkdir(parents=True, exist_ok=True)
+            for sub in ("run", "res", "out", "err", "viz"):
+                dirs_to_create.add(base_dir / sub)
 
             for route in routes:
                 route_suffix = route.stem.split("_")[-1]
                 route_id = route_suffix.zfill(fill_zeros)
 
                 viz_path = base_dir / "viz" / route_id
-                viz_path.parent.mkdir(parents=True, exist_ok=True)
 
                 job = {
                     "cfg": cfg,
@@ -116,21 +174,36 @@ def build_job_queue(configs: List[Dict]) -> List[Dict]:
                     "log_file": base_dir / "out" / f"{route_id}_out.log",
                     "err_file": base_dir / "err" / f"{route_id}_err.log",
                     "remaining_tries": cfg["tries"],
+                    "env_template": env_template,
                 }
                 job_queue.append(job)
 
+    make_dirs(dirs_to_create)
     return job_queue
 
 
 def needs_rerun(job: Dict) -> bool:
     """Determine if a job still needs to run based on its result JSON."""
     result_file: Path = job["result_file"]
-    if not result_file.exists():
+    try:
+        stat = result_file.stat()
+    except FileNotFoundError:
         return True
 
+    cache_key = (str(result_file), stat.st_mtime_ns, stat.st_size)
+    cached = _result_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    need_to_resubmit = _parse_needs_rerun(result_file)
+    _result_cache[cache_key] = need_to_resubmit
+    return need_to_resubmit
+
+
+def _parse_needs_rerun(result_file: Path) -> bool:
+    """Parse the result JSON and decide whether the route has to be rerun."""
     try:
-        with result_file.open("r", encoding="utf-8") as f:
-            evaluation_data = ujson.load(f)
+        evaluation_data = ujson.loads(result_file.read_bytes())
     except Exception:
         return True
 
@@ -140,20 +213,19 @@ def needs_rerun(job: Dict) -> bool:
     except KeyError:
         return True
 
-    need_to_resubmit = False
     if len(progress) < 2 or progress[0] < progress[1]:
-        need_to_resubmit = True
-    else:
-        for record in checkpoint.get("records", []):
-            if record.get("status") in FAIL_STATUSES:
-                need_to_resubmit = True
-                break
+        return True
+    return any(
+        record.get("status") in FAIL_STATUSES
+        for record in checkpoint.get("records", ())
+    )
 
-    return need_to_resubmit
 
+def prepare_environment(cfg: Dict) -> Dict[str, str]:
+    """Create env vars shared by all CARLA evaluation runs of a config.
 
-def prepare_environment(cfg: Dict, viz_path: Path) -> Dict[str, str]:
-    """Create env vars for the CARLA evaluation run."""
+    SAVE_PATH is route specific and added in launch_job.
+    """
     env = os.environ.copy()
     carla_root = cfg["carla_root"]
     repo_root = cfg["repo_root"]
@@ -163,7 +235,6 @@ def prepare_environment(cfg: Dict, viz_path: Path) -> Dict[str, str]:
     env["CARLA_ROOT"] = carla_root
     env["SCENARIO_RUNNER_ROOT"] = scenario_runner_root
     env["LEADERBOARD_ROOT"] = leaderboard_root
-    env["SAVE_PATH"] = str(viz_path)
 
     extra_py_paths = [
         os.path.join(carla_root, "PythonAPI", "carla"),
@@ -185,15 +256,65 @@ def prepare_environment(cfg: Dict, viz_path: Path) -> Dict[str, str]:
     return env
 
 
-def launch_job(job: Dict) -> bool:
-    """Run a single evaluation job locally."""
+def discard_dir_async(path: Path) -> Optional[threading.Thread]:
+    """Move `path` out of the way and delete it in a background thread.
+
+    Returns the deleting thread (to be joined by the caller), or None if `path`
+    does not exist.
+    """
+    if not path.exists():
+        return None
+    trash = path.with_name(f".{path.name}.todelete-{uuid.uuid4().hex}")
+    path.rename(trash)
+    thread = threading.Thread(
+        target=shutil.rmtree, args=(trash,), kwargs={"ignore_errors": True}
+    )
+    thread.start()
+    return thread
+
+
+def drain_stream(stream: IO[bytes], tail: Deque[bytes]) -> None:
+    """Read `stream` line by line until EOF, keeping the last lines in `tail`."""
+    with stream:
+        for line in iter(stream.readline, b""):
+            tail.append(line)
+
+
+def run_with_log_tail(
+    command: List[str], env: Dict[str, str], cwd: str
+) -> Tuple[int, Deque[bytes], Deque[bytes]]:
+    """Run `command` and keep only the last LOG_TAIL_LINES of stdout and stderr."""
+    stdout_tail: Deque[bytes] = deque(maxlen=LOG_TAIL_LINES)
+    stderr_tail: Deque[bytes] = deque(maxlen=LOG_TAIL_LINES)
+    proc = subprocess.Popen(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        bufsize=-1,
+        env=env,
+        cwd=cwd,
+    )
+    readers = [
+        threading.Thread(target=drain_stream, args=(proc.stdout, stdout_tail)),
+        threading.Thread(target=drain_stream, args=(proc.stderr, stderr_tail)),
+    ]
+    for reader in readers:
+        reader.start()
+    returncode = proc.wait()
+    for reader in readers:
+        reader.join()
+    return returncode, stdout_tail, stderr_tail
+
+
+def launch_job(job: Dict, ports: Tuple[int, int]) -> bool:
+    """Run a single evaluation job locally against the CARLA server on `ports`."""
     cfg = job["cfg"]
     viz_path: Path = job["viz_path"]
-    if viz_path.exists():
-        shutil.rmtree(viz_path)
+    # Frames of a previous attempt are deleted while the evaluator starts up
+    cleanup = discard_dir_async(viz_path)
     viz_path.mkdir(parents=True, exist_ok=True)
 
-    env = prepare_environment(cfg, viz_path)
+    env = {**job["env_template"], "SAVE_PATH": str(viz_path)}
     leaderboard_entry = os.path.join(
         cfg["repo_root"],
         "Bench2Drive",
@@ -214,33 +335,68 @@ def launch_job(job: Dict) -> bool:
         f"--agent={cfg['agent_file']}",
         f"--agent-config={cfg['checkpoint']}",
         f"--traffic-manager-seed={job['seed']}",
-        f"--port={cfg['carla_port']}",
-        f"--traffic-manager-port={cfg['carla_tm_port']}",
+        f"--port={ports[0]}",
+        f"--traffic-manager-port={ports[1]}",
     ]
 
     log_path: Path = job["log_file"]
     err_path: Path = job["err_file"]
-    with log_path.open("w", encoding="utf-8") as log_file, err_path.open(
-        "w", encoding="utf-8"
-    ) as err_file:
-        log_file.write(f"COMMAND: {' '.join(command)}\n")
-        log_file.flush()
-        result = subprocess.run(
-            command,
-            stdout=log_file,
-            stderr=err_file,
-            env=env,
-            cwd=cfg["repo_root"],
+    command_line = f"COMMAND: {' '.join(command)}\n".encode("utf-8")
+    try:
+        if cfg["keep_logs_on_success"]:
+            with log_path.open("wb", buffering=LOG_BUFFER_SIZE) as log_file, err_path.open(
+                "wb", buffering=LOG_BUFFER_SIZE
+            ) as err_file:
+                log_file.write(command_line)
+                # Flush before the evaluator starts writing to the same file descriptor
+                log_file.flush()
+                result = subprocess.run(
+                    command,
+                    stdout=log_file,
+                    stderr=err_file,
+                    env=env,
+                    cwd=cfg["repo_root"],
+                )
+            return result.returncode == 0
+
+        # Keep only the tail of the output in memory and write it to disk if the
+        # route failed; successful routes just get a one-line summary.
+        returncode, stdout_tail, stderr_tail = run_with_log_tail(
+            command, env, cfg["repo_root"]
         )
+    finally:
+        if cleanup is not None:
+            cleanup.join()
+
+    failed = returncode != 0 or needs_rerun(job)
+    with log_path.open("wb", buffering=LOG_BUFFER_SIZE) as log_file, err_path.open(
+        "wb", buffering=LOG_BUFFER_SIZE
+    ) as err_file:
+        log_file.write(command_line)
+        if failed:
+            log_file.writelines(stdout_tail)
+            err_file.writelines(stderr_tail)
+        else:
+            log_file.write(
+                f"Finished with exit code {returncode}; output discarded "
+                "(set keep_logs_on_success to keep it).\n".encode("utf-8")
+            )
 
-    return result.returncode == 0
+    return returncode == 0
 
 
-def process_job(job: Dict) -> bool:
+def process_job(job: Dict, ports: Tuple[int, int]) -> bool:
     """Run a job until it succeeds or exhausts retries."""
     total_tries = job["remaining_tries"]
+    # Evaluate the result file once per attempt and carry the verdict over to
+    # the next iteration instead of parsing the same JSON again.
+    rerun = needs_rerun(job)
     while job["remaining_tries"] > 0:
-        if not needs_rerun(job):
+        if _stop_requested.is_set():
+            print(f"[STOP] Route {job['route_id']} seed {job['seed']} interrupted.")
+            return False
+
+        if not rerun:
             print(
                 f"[SKIP] Route {job['route_id']} seed {job['seed']} already completed."
             )
@@ -248,16 +404,17 @@ def process_job(job: Dict) -> bool:
 
         attempt_idx = total_tries - job["remaining_tries"] + 1
         print(f"[RUN ] Route {job['route_id']} seed {job['seed']} attempt {attempt_idx}")
-        success = launch_job(job)
+        success = launch_job(job, ports)
         job["remaining_tries"] -= 1
+        rerun = needs_rerun(job)
 
-        if success and not needs_rerun(job):
+        if success and not rerun:
             print(
                 f"[DONE] Route {job['route_id']} seed {job['seed']} finished successfully."
             )
             return True
 
-        if job["remaining_tries"] > 0:
+        if job["remaining_tries"] > 0 and not _stop_requested.is_set():
             print(
                 f"[RETRY] Route {job['route_id']} seed {job['seed']} "
                 f"retrying ({job['remaining_tries']} tries left)."
@@ -275,24 +432,86 @@ def main():
         print("No jobs discovered. Check your CONFIGS.")
         return
 
-    failures = []
-    progress = tqdm(total=len(job_queue), desc="Bench2Drive routes")
+    _stop_requested.clear()
+
+    # Every (carla_port, carla_tm_port) pair is one CARLA server that can run one
+    # job at a time. Jobs only use the servers of their own config (which may be
+    # a different CARLA build), so every config gets its own pool of free pairs
+    # and its own executor with one worker per pair.
+    free_ports: Dict[int, Queue] = {}
+    executors: Dict[int, ThreadPoolExecutor] = {}
+    port_locks: Dict[Tuple[int, int], threading.Lock] = {}
     for job in job_queue:
+        cfg_key = id(job["cfg"])
+        if cfg_key in free_ports:
+            continue
+        port_pairs = list(dict.fromkeys(job["cfg"]["carla_ports"]))
+        free_ports[cfg_key] = Queue()
+        for pair in port_pairs:
+            free_ports[cfg_key].put(pair)
+            port_locks.setdefault(pair, threading.Lock())
+        executors[cfg_key] = ThreadPoolExecutor(max_workers=len(port_pairs))
+
+    def run_with_free_ports(job: Dict) -> bool:
+        pool = free_ports[id(job["cfg"])]
+        ports = pool.get()
         try:
-            succeeded = process_job(job)
-            if not succeeded:
-                failures.append((job["route_id"], job["seed"]))
+            # Configs listing the same server must not use it at the same time
+            with port_locks[ports]:
+                return process_job(job, ports)
         finally:
-            progress.update(1)
+            pool.put(ports)
+
+    failures = []
+    progress = tqdm(
+        total=len(job_queue),
+        desc="Bench2Drive routes",
+        mininterval=1.0,
+        miniters=max(1, len(job_queue) // 1000),
+    )
+    futures = {}
+    try:
+        for job in job_queue:
+            executor = executors[id(job["cfg"])]
+            futures[executor.submit(run_with_free_ports, job)] = job
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                if not future.result():
+                    failures.append((job["route_id"], job["seed"]))
+            finally:
+                progress.update(1)
+    except BaseException:
+        # e.g. Ctrl-C: the evaluators die with the signal, don't let the
+        # workers treat that as a failed attempt and start the next one
+        _stop_requested.set()
+        for future in futures:
+            future.cancel()
+        raise
+    finally:
+        for executor in executors.values():
+            executor.shutdown(wait=True)
 
     progress.close()
     if failures:
         print("The following jobs failed:")
-        for route_id, seed in failures:
+        for route_id, seed in sorted(failures):
             print(f"  - Route {route_id}, seed {seed}")
     else:
         print("All jobs completed successfully.")
 
+    video_roots = sorted({
+        Path(job["cfg"]["out_root"]) / job["cfg"]["agent"] / job["cfg"]["benchmark"]
+        for job in job_queue
+        if job["cfg"]["create_videos"]
+    })
+    if video_roots:
+        # Imported lazily so the launcher itself does not need OpenCV
+        from create_video_from_images import create_videos_for_eval
+
+        for video_root in video_roots:
+            create_videos_for_eval(video_root)
+
 
 CONFIGS = [
     {
@@ -308,6 +527,15 @@ CONFIGS = [
         "agent_file": "./team_code/agent_simlingo.py",
         "carla_port": 2000,  # Adjust to match your running CARLA server.
         "carla_tm_port": 2500,
+        # One (port, tm_port) pair per running CARLA server; the routes of this
+        # config are evaluated in parallel across them (servers are not shared
+        # with other configs). Defaults to [(carla_port, carla_tm_port)].
+        # "carla_ports": [(2000, 2500), (2002, 2502)],
+        # Write the full evaluator output to the logs even if the route succeeds.
+        # By default only the last lines of failed routes are written.
+        "keep_logs_on_success": False,
+        # Render one video per route from the viz frames after all jobs finished.
+        "create_videos": False,
         "timeout": 600,
     }
     # Add more config entries here if needed.